@@ -2,19 +2,17 @@
 
 import os
 import argparse
-import xml.etree.ElementTree as ET
+from collections import deque
+from lxml import etree
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 from tqdm import tqdm
 
-def parse_cvat_annotations(xml_path):
-    """Parse the CVAT XML file and extract image names and bounding boxes."""
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-    
-    images_data = []
-    
-    # Iterate through all image elements in the XML
-    for image_elem in root.findall('.//image'):
+def iter_cvat_annotations(xml_path):
+    """Lazily yield image names and bounding boxes from the CVAT XML file, one image at a time."""
+    # Stream through image elements as they are closed instead of building the whole tree
+    context = etree.iterparse(xml_path, events=('end',), tag='image')
+    for _, image_elem in context:
         # Get the full image name from XML
         full_image_name = image_elem.get('name')
         # Extract just the filename part (remove any directory components)
@@ -24,7 +22,7 @@ def parse_cvat_annotations(xml_path):
         
         boxes = []
         # Get all bounding boxes for this image
-        for box_elem in image_elem.findall('.//box'):
+        for box_elem in image_elem.iter('box'):
             x_min = float(box_elem.get('xtl'))
             y_min = float(box_elem.get('ytl'))
             x_max = float(box_elem.get('xbr'))
@@ -32,59 +30,99 @@ def parse_cvat_annotations(xml_path):
             
             boxes.append((x_min, y_min, x_max, y_max))
 
-        images_data.append({
+        # Free the processed element and its already-parsed siblings to keep memory constant
+        image_elem.clear()
+        while image_elem.getprevious() is not None:
+            del image_elem.getparent()[0]
+
+        yield {
             'filename': image_name,
             'width': image_width,
             'height': image_height,
             'boxes': boxes
-        })
+        }
+
+def parse_cvat_annotations(xml_path):
+    """Parse the CVAT XML file and extract image names and bounding boxes."""
+    return list(iter_cvat_annotations(xml_path))
+
+def _crop_one(img_data, images_dir, output_dir, padding):
+    """Crop and save all bounding boxes of a single image; return the number of crops saved."""
+    image_path = os.path.join(images_dir, img_data['filename'])
+    
+    # Skip if file doesn't exist
+    if not os.path.exists(image_path):
+        print(f"Warning: Image {img_data['filename']} not found in {images_dir}")
+        return 0
+    
+    crop_count = 0
+    # Open and decode the image once
+    try:
+        img = Image.open(image_path)
+        img.load()
+        
+        # Process each bounding box (encoding already overlaps across images via the process pool)
+        for i, box in enumerate(img_data['boxes']):
+            # Add padding if specified
+            x_min = max(0, int(box[0]) - padding)
+            y_min = max(0, int(box[1]) - padding)
+            x_max = min(img_data['width'], int(box[2]) + padding)
+            y_max = min(img_data['height'], int(box[3]) + padding)
+            
+            # Crop the image using bounding box coordinates
+            cropped_img = img.crop((x_min, y_min, x_max, y_max))
+            
+            # Generate output filename
+            base_name = os.path.splitext(img_data['filename'])[0]
+            output_filename = f"{base_name}_specimen_{i+1}.png"
+            output_path = os.path.join(output_dir, output_filename)
+
+            # Save the cropped image
+            cropped_img.save(output_path)
+            crop_count += 1
+            
+    except Exception as e:
+        print(f"Error processing {image_path}: {e}")
     
-    return images_data
+    return crop_count
 
-def crop_and_save_images(images_data, images_dir, output_dir, padding=0):
-    """Crop images based on bounding boxes and save them."""
+def crop_and_save_images(images_data, images_dir, output_dir, padding=0, num_workers=None):
+    """
+    Crop images based on bounding boxes and save them, one worker process per image.
+
+    images_data may be a list or a lazy iterator (e.g. from iter_cvat_annotations), in which
+    case cropping starts while the rest of the annotation file is still being parsed.
+    """
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
     
-    total_crops = sum(len(img['boxes']) for img in images_data)
-    print(f"Found {len(images_data)} images with {total_crops} total bounding boxes to crop")
+    num_workers = num_workers or os.cpu_count()
+    total = len(images_data) if hasattr(images_data, '__len__') else None
+    if total is not None:
+        print(f"Found {total} images with {sum(len(img['boxes']) for img in images_data)} total bounding boxes to crop")
     
+    num_images = 0
+    total_crops = 0
     crop_count = 0
-    for img_data in tqdm(images_data, desc="Processing images"):
-        image_path = os.path.join(images_dir, img_data['filename'])
-        
-        # Skip if file doesn't exist
-        if not os.path.exists(image_path):
-            print(f"Warning: Image {img_data['filename']} not found in {images_dir}")
-            continue
-        
-        # Open the image
-        try:
-            img = Image.open(image_path)
+    # Bounded queue of in-flight images so the parser never runs far ahead of the workers
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=num_workers) as executor, \
+         tqdm(total=total, desc="Processing images") as progress:
+        for img_data in images_data:
+            num_images += 1
+            total_crops += len(img_data['boxes'])
+            pending.append(executor.submit(_crop_one, img_data, images_dir, output_dir, padding))
             
-            # Process each bounding box
-            for i, box in enumerate(img_data['boxes']):
-                # Add padding if specified
-                x_min = max(0, int(box[0]) - padding)
-                y_min = max(0, int(box[1]) - padding)
-                x_max = min(img_data['width'], int(box[2]) + padding)
-                y_max = min(img_data['height'], int(box[3]) + padding)
-                
-                # Crop the image using bounding box coordinates
-                cropped_img = img.crop((x_min, y_min, x_max, y_max))
-                
-                # Generate output filename
-                base_name = os.path.splitext(img_data['filename'])[0]
-                output_filename = f"{base_name}_specimen_{i+1}.png"
-                output_path = os.path.join(output_dir, output_filename)
-
-                # Save the cropped image
-                cropped_img.save(output_path)
-                crop_count += 1
-                
-        except Exception as e:
-            print(f"Error processing {image_path}: {e}")
+            if len(pending) >= 2 * num_workers:
+                crop_count += pending.popleft().result()
+                progress.update()
+        
+        while pending:
+            crop_count += pending.popleft().result()
+            progress.update()
     
+    if total is None:
+        print(f"Processed {num_images} images with {total_crops} total bounding boxes")
     print(f"Successfully cropped and saved {crop_count} beetle images")
 
 def main():
@@ -93,16 +131,17 @@ def main():
     parser.add_argument("--images_dir", required=True, help="Directory containing the original images")
     parser.add_argument("--output_dir", required=True, help="Directory to save the cropped beetle images")
     parser.add_argument("--padding", type=int, default=0, help="Additional padding around each bounding box (default: 5 pixels)")
+    parser.add_argument("--num_workers", type=int, default=None, help="Number of worker processes (default: CPU count)")
     
     args = parser.parse_args()
     
-    # Parse the XML annotations
+    # Parse the XML annotations lazily so cropping overlaps with parsing
     print(f"Parsing annotations from {args.xml_file}...")
-    images_data = parse_cvat_annotations(args.xml_file)
+    images_data = iter_cvat_annotations(args.xml_file)
     
     # Crop and save images
     print(f"Cropping beetle images and saving to {args.output_dir}...")
-    crop_and_save_images(images_data, args.images_dir, args.output_dir, args.padding)
+    crop_and_save_images(images_data, args.images_dir, args.output_dir, args.padding, args.num_workers)
 
 if __name__ == "__main__":
     main()
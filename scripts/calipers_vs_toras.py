@@ -16,7 +16,6 @@ import os
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.metrics import mean_squared_error, r2_score
 
 
 # ---------------------------------------------------------
@@ -55,14 +54,39 @@ if missing_cols:
 # ---------------------------------------------------------
 # === Helper Function: Compute Metrics ===
 # ---------------------------------------------------------
-def compute_agreement_metrics(x, y):
-    """Compute RMSE, R², and bias between two numeric arrays."""
-    rmse = np.sqrt(mean_squared_error(y, x))
-    r2 = r2_score(y, x)
-    bias = np.mean(x - y)
+def compute_agreement_metrics(H, y):
+    """
+    Compute RMSE, R², and bias of every column of H (N, K) against y (N,) in one pass.
+    Rows where either value is NaN are ignored per column. Returns three (K,) arrays.
+    """
+    diff = H - y[:, None]
+    valid = ~np.isnan(diff)
+    y_valid = np.where(valid, y[:, None], np.nan)
+
+    rmse = np.sqrt(np.nanmean(diff ** 2, axis=0))
+    bias = np.nanmean(diff, axis=0)
+    sse = np.nansum(diff ** 2, axis=0)
+    sst = np.nansum((y_valid - np.nanmean(y_valid, axis=0)) ** 2, axis=0)
+    r2 = 1 - sse / sst
     return rmse, r2, bias
 
 
+# ---------------------------------------------------------
+# === Compute Metrics: Each Human and Their Average vs System ===
+# ---------------------------------------------------------
+human_cols = [pair[0] for pair in ANNOTATOR_PAIRS]
+H = df[human_cols].to_numpy(dtype=float)
+S = df["System_length"].to_numpy(dtype=float)
+
+df["HumanAvg_length"] = df[human_cols].mean(axis=1)   # NaN (silently) where no human measured
+H = np.column_stack([H, df["HumanAvg_length"].to_numpy()])
+
+rmse_all, r2_all, bias_all = compute_agreement_metrics(H, S)
+
+# Per-column mask of rows where both the human value and the system value are present
+valid = ~np.isnan(H) & ~np.isnan(S)[:, None]
+
+
 # ---------------------------------------------------------
 # === Plot Comparison: Human vs System ===
 # ---------------------------------------------------------
@@ -71,14 +95,13 @@ fig, axes = plt.subplots(1, 3, figsize=(24, 6))
 
 metrics_summary = []
 
-for ax, (human_col, sys_col, title, human_label) in zip(axes, ANNOTATOR_PAIRS):
-    df_sub = df[[human_col, sys_col]].dropna()
-    x = df_sub[human_col].values
-    y = df_sub[sys_col].values
+for i, (ax, (_, _, title, human_label)) in enumerate(zip(axes, ANNOTATOR_PAIRS)):
+    mask = valid[:, i]
+    x = H[mask, i]
+    y = S[mask]
 
-    # Compute metrics
-    rmse, r2, bias = compute_agreement_metrics(x, y)
-    metrics_summary.append((title, rmse, r2, bias))
+    # Collect metrics
+    metrics_summary.append((title, rmse_all[i], r2_all[i], bias_all[i]))
 
     # Scatter plot
     ax.scatter(x, y, color='steelblue', s=60, edgecolor='black', linewidth=0.3)
@@ -103,15 +126,7 @@ axes[0].legend(loc='upper left', fontsize=18, frameon=True)
 # ---------------------------------------------------------
 # === Average of Human Annotators vs System ===
 # ---------------------------------------------------------
-human_cols = [pair[0] for pair in ANNOTATOR_PAIRS]
-df["HumanAvg_length"] = df[human_cols].mean(axis=1)
-df_sub = df[["HumanAvg_length", "System_length"]].dropna()
-
-x_avg = df_sub["HumanAvg_length"].values
-y_sys = df_sub["System_length"].values
-
-rmse_avg, r2_avg, bias_avg = compute_agreement_metrics(x_avg, y_sys)
-metrics_summary.append(("Average Human vs Automated System", rmse_avg, r2_avg, bias_avg))
+metrics_summary.append(("Average Human vs Automated System", rmse_all[-1], r2_all[-1], bias_all[-1]))
 
 
 # ---------------------------------------------------------
@@ -119,7 +134,7 @@ metrics_summary.append(("Average Human vs Automated System", rmse_avg, r2_avg, b
 # ---------------------------------------------------------
 os.makedirs("figures", exist_ok=True)
 output_path = os.path.join("figures", OUTPUT_FIG)
-plt.savefig(output_path, format='pdf', bbox_inches='tight', dpi=600)
+plt.savefig(output_path, format='pdf', bbox_inches='tight')   # all-vector content, dpi has no effect
 plt.show()
 
 print(f"✅ Final plot saved at: {output_path}\n")
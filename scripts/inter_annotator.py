@@ -10,10 +10,14 @@ multiple human annotators and computes agreement metrics:
 """
 
 import os
-import pandas as pd
 import numpy as np
+import matplotlib
+if not os.environ.get("SHOW_FIG"):
+    matplotlib.use("Agg")   # PDF-only run: skip GUI toolkit import and display setup
 import matplotlib.pyplot as plt
-from sklearn.metrics import mean_squared_error, r2_score
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
 
 # ---------------------------------------------------------
 # === Configuration ===
@@ -23,6 +27,12 @@ from sklearn.metrics import mean_squared_error, r2_score
 DATA_PATH = "data/traits.csv"                       # anonymized path
 OUTPUT_FIG = "InterAnnotatorAgreement.pdf"          # output figure name
 
+# (input CSV, output figure) for every dataset to analyze; the figure is reused across them.
+# Each CSV gets a <name>.parquet cache of the parsed columns, rebuilt when the CSV changes.
+DATASETS = [
+    (DATA_PATH, OUTPUT_FIG),
+]
+
 
 # Define inter-annotator pairs (anonymized)
 ANNOTATOR_PAIRS = [
@@ -34,83 +44,213 @@ ANNOTATOR_PAIRS = [
 # Axis limits for plotting
 LIM_MIN, LIM_MAX = 0.15, 0.65
 
+# Perfect agreement (y = x) line, shared by all panels
+DIAG_XY = ([LIM_MIN, LIM_MAX], [LIM_MIN, LIM_MAX])
+DIAG_KW = dict(linestyle='--', color='orange', linewidth=2, label='Perfect agreement')
+
+# Above this many points per pair, plot density (hexbin) instead of individual markers
+HEXBIN_THRESHOLD = 2000
+
+# Rows (Parquet) / bytes (CSV) per chunk when streaming the traits table, and max points per pair kept for plotting
+CHUNK_SIZE = 200_000
+CSV_BLOCK_SIZE = 16 << 20
+PLOT_SAMPLE_SIZE = 100_000
+
 
 # ---------------------------------------------------------
-# === Load Data ===
+# === Load Data (streamed in chunks) ===
 # ---------------------------------------------------------
-df = pd.read_csv(DATA_PATH)
+# Only parse the annotator columns (pyarrow raises ArrowKeyError if any are missing);
+# float32 is ample for lengths in [LIM_MIN, LIM_MAX] and halves memory traffic
+required_cols = list(dict.fromkeys(col for pair in ANNOTATOR_PAIRS for col in pair[:2]))
+
+
+def iter_trait_chunks(data_path):
+    """Yield float32 DataFrames of the annotator columns, one chunk at a time."""
+    cache_path = os.path.splitext(data_path)[0] + ".parquet"
+    # The cache records the size and mtime of the CSV it was built from; any mismatch means the CSV changed
+    source_stat = os.stat(data_path)
+    source_meta = {b"source_size": str(source_stat.st_size).encode(),
+                   b"source_mtime_ns": str(source_stat.st_mtime_ns).encode()}
+    cache_fresh = False
+    if os.path.exists(cache_path):
+        cache_schema = pq.read_schema(cache_path)
+        cache_meta = cache_schema.metadata or {}
+        cache_fresh = (all(cache_meta.get(key) == value for key, value in source_meta.items())
+                       and set(required_cols) <= set(cache_schema.names))
+    if cache_fresh:
+        for batch in pq.ParquetFile(cache_path).iter_batches(batch_size=CHUNK_SIZE, columns=required_cols):
+            yield batch.to_pandas()
+        return
+
+    # Parse the CSV once with Arrow's multi-threaded columnar reader,
+    # writing the Parquet cache alongside (moved into place only when complete)
+    reader = pv.open_csv(
+        data_path,
+        read_options=pv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        convert_options=pv.ConvertOptions(include_columns=required_cols,
+                                          column_types={col: pa.float32() for col in required_cols}),
+    )
+    tmp_path = cache_path + ".tmp"
+    try:
+        writer = pq.ParquetWriter(tmp_path, reader.schema.with_metadata(source_meta))
+    except OSError as e:
+        # e.g. read-only data directory: analyse straight from the CSV without caching
+        print(f"Warning: could not create Parquet cache {cache_path} ({e}); reading {data_path} directly.")
+        for batch in reader:
+            yield batch.to_pandas()
+        return
+    try:
+        with writer:
+            for batch in reader:
+                writer.write_batch(batch)
+                yield batch.to_pandas()
+    except BaseException:
+        # Conversion error or interrupted run: don't leave a partial cache file behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, cache_path)
+
 
-# Optional: check columns
-required_cols = [x[0] for x in ANNOTATOR_PAIRS] + [x[1] for x in ANNOTATOR_PAIRS]
-missing = [col for col in required_cols if col not in df.columns]
-if missing:
-    raise ValueError(f"Missing columns in input CSV: {missing}")
+def update_sample(sample, keys, xy, rng):
+    """Merge new (x, y) points into a uniform random sample of at most PLOT_SAMPLE_SIZE points."""
+    sample = np.concatenate([sample, xy])
+    keys = np.concatenate([keys, rng.random(len(xy))])
+    if len(keys) > PLOT_SAMPLE_SIZE:
+        # Keeping the points with the smallest random keys is a uniform sample of everything seen
+        keep = np.argpartition(keys, PLOT_SAMPLE_SIZE)[:PLOT_SAMPLE_SIZE]
+        sample, keys = sample[keep], keys[keep]
+    return sample, keys
+
+
+# ---------------------------------------------------------
+# === Compute Metrics (all pairs at once, chunk by chunk) ===
+# ---------------------------------------------------------
+def compute_agreement(data_path):
+    """Return per-pair RMSE, R², bias arrays and a list of (n, 2) plotting samples for one dataset."""
+    num_pairs = len(ANNOTATOR_PAIRS)
+    stats = np.zeros((5, num_pairs))   # Per pair: n, Σd, Σy, Σd², Σy² (float64 accumulators)
+    samples = [np.empty((0, 2), dtype=np.float32) for _ in range(num_pairs)]
+    sample_keys = [np.empty(0) for _ in range(num_pairs)]
+    rng = np.random.default_rng(0)
+
+    for chunk in iter_trait_chunks(data_path):
+        # Column k of X / Y holds the x / y annotator of pair k; rows with a NaN in a pair are ignored for that pair
+        # Each annotator column appears in two pairs: materialize it and its NaN mask only once
+        cols = {col: chunk[col].to_numpy(copy=False) for col in required_cols}
+        present = {col: ~np.isnan(values) for col, values in cols.items()}
+
+        X = np.column_stack([cols[pair[0]] for pair in ANNOTATOR_PAIRS])
+        Y = np.column_stack([cols[pair[1]] for pair in ANNOTATOR_PAIRS])
+        valid = np.column_stack([present[pair[0]] & present[pair[1]] for pair in ANNOTATOR_PAIRS])
+
+        # Stack differences and y values as (N, 2, pairs); masked rows are zero so they drop out of the sums
+        terms = np.where(valid[:, None, :], np.stack([X - Y, Y], axis=1), 0)
+
+        # All sufficient statistics in two reductions
+        stats[0] += valid.sum(axis=0)
+        stats[1:3] += terms.sum(axis=0, dtype=np.float64)
+        stats[3:5] += np.einsum('nkp,nkp->kp', terms, terms, dtype=np.float64)
+
+        # Keep a bounded sample of points per pair for plotting
+        for i in range(num_pairs):
+            mask = valid[:, i]
+            xy = np.column_stack([X[mask, i], Y[mask, i]])
+            samples[i], sample_keys[i] = update_sample(samples[i], sample_keys[i], xy, rng)
+
+    n, sum_d, sum_y, sum_d2, sum_y2 = stats
+    ss_tot = sum_y2 - sum_y ** 2 / n
+
+    rmse_all = np.sqrt(sum_d2 / n)
+    bias_all = sum_d / n
+    r2_all = 1 - sum_d2 / ss_tot
+    return rmse_all, r2_all, bias_all, samples
 
 
 # ---------------------------------------------------------
 # === Create Plots ===
 # ---------------------------------------------------------
 plt.style.use('seaborn-v0_8-whitegrid')
-fig, axes = plt.subplots(1, 3, figsize=(24, 6))
 
-results = []
+# Shared text/tick styling, set once instead of per axis
+plt.rcParams.update({
+    'axes.titlesize': 24, 'axes.titleweight': 'bold', 'axes.titlepad': 12,
+    'axes.labelsize': 22, 'axes.labelweight': 'bold', 'axes.labelpad': 12,
+    'xtick.labelsize': 18, 'ytick.labelsize': 18,
+})
+
+# One figure for all datasets: panels are cleared and redrawn instead of rebuilt
+# All panels use the same limits, so share the axes (ticks are computed once)
+# dpi is fixed at creation (it only affects the raster layer) so saving does not re-layout text
+fig, axes = plt.subplots(1, 3, figsize=(24, 6), dpi=300, sharex=True, sharey=True)
+plt.subplots_adjust(wspace=0.3, right=0.88)
 
-for ax, (x_col, y_col, title, x_label, y_label) in zip(axes, ANNOTATOR_PAIRS):
-    df_sub = df[[x_col, y_col]].dropna()
-    x = df_sub[x_col].values
-    y = df_sub[y_col].values
 
-    # --- Compute metrics ---
-    rmse = np.sqrt(mean_squared_error(y, x))
-    r2 = r2_score(y, x)
-    bias = np.mean(x - y)
-    results.append((title, rmse, r2, bias))
+def make_figure(samples, output_path):
+    """Redraw the agreement panels for one dataset's plotting samples and save the figure."""
+    for ax in axes:
+        ax.cla()
+    axes[0].set_xlim(LIM_MIN, LIM_MAX)
+    axes[0].set_ylim(LIM_MIN, LIM_MAX)
 
-    # --- Plot scatter ---
-    ax.scatter(x, y, color='steelblue', s=60, edgecolor='black', linewidth=0.3)
+    for ax, sample, (x_col, y_col, title, x_label, y_label) in zip(axes, samples, ANNOTATOR_PAIRS):
+        x, y = sample[:, 0], sample[:, 1]
 
-    # Perfect agreement line
-    ax.plot([LIM_MIN, LIM_MAX], [LIM_MIN, LIM_MAX],
-            linestyle='--', color='orange', linewidth=2, label='Perfect agreement')
+        # --- Plot scatter (or density for very large N) ---
+        if len(x) > HEXBIN_THRESHOLD:
+            ax.hexbin(x, y, gridsize=60, extent=(LIM_MIN, LIM_MAX, LIM_MIN, LIM_MAX),
+                      cmap='Blues', mincnt=1, rasterized=True)
+        else:
+            # At most HEXBIN_THRESHOLD markers: vector paths are smaller than a 300-dpi raster layer
+            ax.scatter(x, y, color='steelblue', s=60, edgecolor='black', linewidth=0.3)
 
-    # Formatting
-    ax.set_xlabel(x_label, fontsize=22, labelpad=12, fontweight='bold')
-    ax.set_ylabel(y_label, fontsize=22, labelpad=12, fontweight='bold')
-    ax.set_title(title, fontsize=24, fontweight='bold', pad=12)
-    ax.set_xlim(LIM_MIN, LIM_MAX)
-    ax.set_ylim(LIM_MIN, LIM_MAX)
-    ax.tick_params(axis='both', labelsize=18)
+        # Perfect agreement line
+        ax.plot(*DIAG_XY, **DIAG_KW)
 
-# Adjust layout
-plt.subplots_adjust(wspace=0.3, right=0.88)
-axes[0].legend(loc='upper left', fontsize=18, frameon=True)
+        # Formatting
+        ax.set_xlabel(x_label)
+        ax.set_ylabel(y_label)
+        ax.set_title(title)
 
-# Save output
-os.makedirs("figures", exist_ok=True)
-output_path = os.path.join("figures", OUTPUT_FIG)
-plt.savefig(output_path, format='pdf', bbox_inches='tight', dpi=600)
-plt.show()
+    axes[0].legend(loc='upper left', fontsize=18, frameon=True)
 
+    fig.savefig(output_path, format='pdf', bbox_inches='tight', dpi='figure')
 
 
 # ---------------------------------------------------------
-# === Display Summary ===
+# === Run All Datasets & Display Summary ===
 # ---------------------------------------------------------
-print(f"✅ Inter-Annotator Agreement figure saved at: {output_path}\n")
-
-print("📊 === Inter-Annotator Agreement Metrics ===")
-for title, rmse, r2, bias in results:
-    print(f"{title}:")
-    print(f"   RMSE       = {rmse:.4f}")
-    print(f"   R² Score   = {r2:.4f}")
-    print(f"   Avg. Bias  = {bias:.4f}\n")
-
-# Overall averages
-avg_rmse = np.mean([r[1] for r in results])
-avg_r2   = np.mean([r[2] for r in results])
-avg_bias = np.mean([r[3] for r in results])
-
-print("📈 === Average Across All Annotator Pairs ===")
-print(f"   RMSE (mean)  = {avg_rmse:.4f}")
-print(f"   R² (mean)    = {avg_r2:.4f}")
-print(f"   Bias (mean)  = {avg_bias:.4f}")
+os.makedirs("figures", exist_ok=True)
+
+for data_path, output_fig in DATASETS:
+    rmse_all, r2_all, bias_all, samples = compute_agreement(data_path)
+
+    # Save output
+    output_path = os.path.join("figures", output_fig)
+    make_figure(samples, output_path)
+    if os.environ.get("SHOW_FIG"):   # Only open a window when asked; batch runs just need the PDF
+        plt.show()
+
+    results = [(pair[2], rmse_all[i], r2_all[i], bias_all[i]) for i, pair in enumerate(ANNOTATOR_PAIRS)]
+
+    print(f"✅ Inter-Annotator Agreement figure saved at: {output_path}\n")
+
+    print("📊 === Inter-Annotator Agreement Metrics ===")
+    for title, rmse, r2, bias in results:
+        print(f"{title}:")
+        print(f"   RMSE       = {rmse:.4f}")
+        print(f"   R² Score   = {r2:.4f}")
+        print(f"   Avg. Bias  = {bias:.4f}\n")
+
+    # Overall averages
+    avg_rmse = np.mean([r[1] for r in results])
+    avg_r2   = np.mean([r[2] for r in results])
+    avg_bias = np.mean([r[3] for r in results])
+
+    print("📈 === Average Across All Annotator Pairs ===")
+    print(f"   RMSE (mean)  = {avg_rmse:.4f}")
+    print(f"   R² (mean)    = {avg_r2:.4f}")
+    print(f"   Bias (mean)  = {avg_bias:.4f}")
+
+plt.close(fig)
@@ -1,16 +1,60 @@
 #!/usr/bin/env python3
 
-import csv
 import json
 import os
+import cv2
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image
 import numpy as np
+import pandas as pd
+from tqdm import tqdm
 
 # Set Base Directories
 BASE_DIR = "path/to/2018-NEON-beetles"
 ORIGINAL_GROUP_IMAGES_DIR = os.path.join(BASE_DIR, "group_images")
 PROCESS_DIR = os.path.join(BASE_DIR, "processed_images")
 
+def _uniform_scale_for(resized_filename):
+    """
+    Compute the uniform scaling factor for one resized group image.
+    Returns (picture_id, uniform_scale), or (picture_id, None) if it cannot be computed.
+    """
+    # Extract picture_id (remove extension)
+    picture_id = os.path.splitext(resized_filename)[0]
+    
+    # Find corresponding original image
+    original_path = None
+    for ext in ['.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG']:
+        potential_path = os.path.join(ORIGINAL_GROUP_IMAGES_DIR, picture_id + ext)
+        if os.path.exists(potential_path):
+            original_path = potential_path
+            break
+    
+    if original_path is None:
+        print(f"Warning: No original image found for {picture_id}")
+        return picture_id, None
+    
+    resized_path = os.path.join(PROCESS_DIR, resized_filename)
+
+    try:
+        # Image.open only parses the file header; .size needs no pixel decode
+        with Image.open(original_path) as orig_img:
+            orig_width, orig_height = orig_img.size
+        
+        with Image.open(resized_path) as resized_img:
+            resized_width, resized_height = resized_img.size
+        
+        # Calculate scaling factors (original / resized)
+        scale_x = orig_width / resized_width
+        scale_y = orig_height / resized_height
+        
+        # Use uniform scaling factor (average of x and y)
+        return picture_id, (scale_x + scale_y) / 2
+            
+    except Exception as e:
+        print(f"Error processing {picture_id}: {e}")
+        return picture_id, None
+
 def calculate_uniform_scaling_factors():
     """
     Calculate uniform scaling factors between original group images and BeetlePalooza resized images.
@@ -29,47 +73,17 @@ def calculate_uniform_scaling_factors():
     print(f"Found {len(resized_files)} resized images")
     
     processed = 0
-    for resized_filename in resized_files:
-        # Extract picture_id (remove extension)
-        picture_id = os.path.splitext(resized_filename)[0]
-        
-        # Find corresponding original image
-        original_path = None
-        for ext in ['.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG']:
-            potential_path = os.path.join(ORIGINAL_GROUP_IMAGES_DIR, picture_id + ext)
-            if os.path.exists(potential_path):
-                original_path = potential_path
-                break
-        
-        if original_path is None:
-            print(f"Warning: No original image found for {picture_id}")
-            continue
-        
-        # Load both images and get dimensions
-        resized_path = os.path.join(PROCESS_DIR, resized_filename)
-
-        try:
-            with Image.open(original_path) as orig_img:
-                orig_width, orig_height = orig_img.size
-            
-            with Image.open(resized_path) as resized_img:
-                resized_width, resized_height = resized_img.size
-            
-            # Calculate scaling factors (original / resized)
-            scale_x = orig_width / resized_width
-            scale_y = orig_height / resized_height
-            
-            # Use uniform scaling factor (average of x and y)
-            uniform_scale = (scale_x + scale_y) / 2
+    # Header reads are I/O bound, so overlap them across threads
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        for picture_id, uniform_scale in executor.map(_uniform_scale_for, resized_files):
+            if uniform_scale is None:
+                continue
             
             scaling_factors[picture_id] = uniform_scale
             processed += 1
             
             if processed % 100 == 0:
                 print(f"  Processed {processed} images...")
-                
-        except Exception as e:
-            print(f"Error processing {picture_id}: {e}")
     
     print(f"Calculated uniform scaling factors for {len(scaling_factors)} images")
     
@@ -99,18 +113,31 @@ def resize_image_uniform(input_path, output_path, scale_factor):
         output_path: Path to save resized image
         scale_factor: Uniform scaling factor (original_size / resized_size)
     """
-    with Image.open(input_path) as img:
-        original_width, original_height = img.size
-        
-        # Calculate new dimensions using uniform scaling
-        new_width = int(original_width / scale_factor)
-        new_height = int(original_height / scale_factor)
-        
-        # Resize using high-quality resampling
-        resized_img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        # Save the resized image
-        resized_img.save(output_path, optimize=True)
+    img = cv2.imread(input_path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise IOError(f"Could not read image {input_path}")
+    original_height, original_width = img.shape[:2]
+    
+    # Calculate new dimensions using uniform scaling
+    new_width = int(original_width / scale_factor)
+    new_height = int(original_height / scale_factor)
+    
+    # Resize with SIMD OpenCV kernels: area averaging when shrinking, Lanczos when enlarging
+    interpolation = cv2.INTER_AREA if scale_factor > 1 else cv2.INTER_LANCZOS4
+    resized_img = cv2.resize(img, (new_width, new_height), interpolation=interpolation)
+    
+    # Save the resized image
+    if not cv2.imwrite(output_path, resized_img, [cv2.IMWRITE_PNG_COMPRESSION, 3]):
+        raise IOError(f"Could not write image {output_path}")
+
+def _resize_worker(task):
+    """Resize one (input_path, output_path, scale_factor) task; return an error message or None."""
+    input_path, output_path, scale_factor = task
+    try:
+        resize_image_uniform(input_path, output_path, scale_factor)
+    except Exception as e:
+        return f"Error processing {input_path}: {str(e)}"
+    return None
 
 def resize_individual_images_uniform():
     """
@@ -137,31 +164,30 @@ def resize_individual_images_uniform():
     # Create output directory
     os.makedirs(output_dir, exist_ok=True)
     
-    # Read CSV file
-    individual_images = []
-    with open(csv_file, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            individual_images.append(row)
+    # Read CSV file (all columns as plain strings, like csv.DictReader)
+    individual_images = pd.read_csv(csv_file, dtype=str, keep_default_na=False)
     
-    print(f"Found {len(individual_images)} individual images to process")
+    total_individual_images = len(individual_images)
+    print(f"Found {total_individual_images} individual images to process")
     
     processed = 0
     skipped = 0
     errors = 0
     
-    for row in individual_images:
+    # picture_id = group image filename without directory or extension
+    individual_images["picture_id"] = (individual_images["groupImageFilePath"]
+                                       .str.rsplit("/", n=1).str[-1]
+                                       .str.rsplit(".", n=1).str[0])
+    
+    # Keep only rows whose group image has a scaling factor
+    has_scale = individual_images["picture_id"].isin(list(scaling_factors))
+    skipped += int((~has_scale).sum())
+    individual_images = individual_images.loc[has_scale, ["individualImageFilePath", "picture_id"]]
+    
+    # Collect resize tasks serially (cheap existence checks), then resize in parallel
+    tasks = []
+    for individual_path_rel, picture_id in individual_images.itertuples(index=False, name=None):
         try:
-            # Get the image paths
-            individual_path_rel = row['individualImageFilePath']
-            group_image_filename = os.path.basename(row['groupImageFilePath'])
-            picture_id = os.path.splitext(group_image_filename)[0]
-            
-            # Check if we have scaling factors for this group image
-            if picture_id not in scaling_factors:
-                skipped += 1
-                continue
-            
             # Full path to individual image
             individual_path_full = os.path.join(BASE_DIR, individual_path_rel)
             
@@ -176,17 +202,22 @@ def resize_individual_images_uniform():
             # Get uniform scaling factor
             scale_factor = scaling_factors[picture_id]
             
-            # Resize the image using uniform scaling
-            resize_image_uniform(individual_path_full, output_path, scale_factor)
-            
-            processed += 1
-            if processed % 100 == 0:
-                print(f"  Processed {processed} images...")
+            tasks.append((individual_path_full, output_path, scale_factor))
                 
         except Exception as e:
             print(f"Error processing {individual_path_rel}: {str(e)}")
             errors += 1
     
+    # Resize the images using uniform scaling, one worker process per CPU core
+    with ProcessPoolExecutor() as executor:
+        for error in tqdm(executor.map(_resize_worker, tasks, chunksize=16),
+                          total=len(tasks), desc="Resizing images"):
+            if error is None:
+                processed += 1
+            else:
+                print(error)
+                errors += 1
+    
     print(f"\nProcessing complete!")
     print(f"  Successfully processed: {processed}")
     print(f"  Skipped (no scaling factor): {skipped}")
@@ -195,7 +226,7 @@ def resize_individual_images_uniform():
     
     # Save processing summary
     summary = {
-        "total_individual_images": len(individual_images),
+        "total_individual_images": total_individual_images,
         "successfully_processed": processed,
         "skipped_no_scaling_factor": skipped,
         "errors": errors,
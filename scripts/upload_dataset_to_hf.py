@@ -28,13 +28,26 @@ def main():
     parser.add_argument(
         "--path_in_repo",
         default="images",
-        help="Sub‐folder inside the dataset repo where files will live",
+        help="Sub‐folder inside the dataset repo where files will live "
+             "(use \"\" to mirror the folder at the repo root with parallel, resumable uploads)",
     )
     parser.add_argument(
         "--branch",
         default="main",
         help="Branch name to upload to (default: main)",
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=16,
+        help="Number of parallel upload workers for root-level uploads (default: 16)",
+    )
+    parser.add_argument(
+        "--allow_patterns",
+        nargs="+",
+        default=None,
+        help="Only upload files matching these glob patterns, e.g. '*.png' '*.csv' (default: all files)",
+    )
     args = parser.parse_args()
 
     hf_token = os.getenv("HF_TOKEN")
@@ -61,13 +74,26 @@ def main():
             print(f"Branch '{args.branch}' created successfully.")
 
     print(f"Uploading folder {args.folder_path} to {args.repo_id} ({args.repo_type}) on branch '{args.branch}'…")
-    api.upload_folder(
-        folder_path=args.folder_path,
-        repo_id=args.repo_id,
-        repo_type=args.repo_type,
-        path_in_repo=args.path_in_repo,
-        revision=args.branch,
-    )
+    if not args.path_in_repo:
+        # Multi-worker, resumable upload split over many commits (mirrors folder at repo root)
+        api.upload_large_folder(
+            folder_path=args.folder_path,
+            repo_id=args.repo_id,
+            repo_type=args.repo_type,
+            revision=args.branch,
+            allow_patterns=args.allow_patterns,
+            num_workers=args.num_workers,
+        )
+    else:
+        # upload_large_folder cannot target a sub-folder, so use a single-commit upload
+        api.upload_folder(
+            folder_path=args.folder_path,
+            repo_id=args.repo_id,
+            repo_type=args.repo_type,
+            path_in_repo=args.path_in_repo,
+            revision=args.branch,
+            allow_patterns=args.allow_patterns,
+        )
     print("Upload complete.")
 
 